@@ -1,16 +1,189 @@
 # Import required FastAPI components for building the API
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 # Import Pydantic for data validation and settings management
-from pydantic import BaseModel
-# Import OpenAI client for interacting with OpenAI's API
-from openai import OpenAI
+from pydantic import BaseModel, ConfigDict
+# Import the async OpenAI client so streamed chunks are consumed without blocking the event loop
+from openai import AsyncOpenAI
 import os
-from typing import Optional
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+# Static formatting instructions appended to every system message, pre-joined once
+# at import so each request sends a single system message instead of three
+STATIC_SYSTEM_PROMPT = (
+    "Do not produce answers greater than 500 words\n\n"
+    "Use $...$ for inline math and $$...$$ for block math. Do not use square brackets [ ... ] for mathematical expressions. Remove any spaces between the closing $ and the content of the expression."
+)
+
+# Cap on concurrent in-flight chat streams per API key. OpenAI rate limits apply
+# per key, so each key gets its own limit and one caller's burst cannot block the
+# others (override with MAX_CHAT_CONCURRENCY)
+MAX_CHAT_CONCURRENCY = int(os.getenv("MAX_CHAT_CONCURRENCY", "8"))
+
+# Process-wide cap on concurrent in-flight chat streams across all keys, so the
+# total number of upstream connections stays bounded (override with
+# MAX_TOTAL_CHAT_CONCURRENCY)
+CHAT_SEM = asyncio.Semaphore(int(os.getenv("MAX_TOTAL_CHAT_CONCURRENCY", "32")))
+
+# Seconds a request waits for a free slot before being rejected with a 429
+# instead of hanging (override with CHAT_QUEUE_TIMEOUT)
+CHAT_QUEUE_TIMEOUT = float(os.getenv("CHAT_QUEUE_TIMEOUT", "10"))
+
+# Streamed text is buffered and written to the client once this many characters
+# have built up or it has waited STREAM_FLUSH_INTERVAL seconds
+STREAM_FLUSH_CHARS = 512
+
+# Flush window for buffered streamed text, short enough that streaming still
+# feels interactive
+STREAM_FLUSH_INTERVAL = 0.02
+
+# Maximum number of OpenAI clients kept alive at once (one per distinct API key)
+MAX_CACHED_CLIENTS = 32
+
+# Cache of AsyncOpenAI clients keyed by a SHA-256 hash of the API key, so repeat
+# callers reuse a warm, keep-alive connection pool instead of a fresh one per request
+_clients: "OrderedDict[str, AsyncOpenAI]" = OrderedDict()
+
+# Per-key stream limits as [semaphore, users], where users counts the requests
+# waiting on or holding a slot. They are kept apart from the client LRU so a key's
+# limit is never dropped while it still has streams, and removed once it has none.
+_key_limits: dict[str, list] = {}
+
+# Key used for both caches, so plaintext API keys are never stored as dict keys
+def hash_api_key(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+def get_client(api_key: str) -> AsyncOpenAI:
+    # Look up the cached client for this key, creating it on first use
+    key_hash = hash_api_key(api_key)
+    client = _clients.get(key_hash)
+    if client is None:
+        client = AsyncOpenAI(api_key=api_key)
+        _clients[key_hash] = client
+        # Evict the least recently used client; it is not closed here because an
+        # in-flight stream may still be using it, so it is released once unreferenced
+        if len(_clients) > MAX_CACHED_CLIENTS:
+            _clients.popitem(last=False)
+    else:
+        # Mark this client as the most recently used
+        _clients.move_to_end(key_hash)
+    return client
+
+async def acquire_chat_slot(api_key: str, timeout: float):
+    # Take a slot from the key's limit and then the process-wide limit, waiting at
+    # most `timeout` seconds in total (raises TimeoutError). Returns a callable that
+    # releases both slots; calling it more than once is a no-op.
+    key_hash = hash_api_key(api_key)
+    entry = _key_limits.get(key_hash)
+    if entry is None:
+        entry = _key_limits[key_hash] = [asyncio.Semaphore(MAX_CHAT_CONCURRENCY), 0]
+    semaphore = entry[0]
+    entry[1] += 1
+
+    def forget():
+        # Drop the key's limit once no request is waiting on or holding it
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _key_limits[key_hash]
+
+    try:
+        async with asyncio.timeout(timeout):
+            await semaphore.acquire()
+            try:
+                await CHAT_SEM.acquire()
+            except BaseException:
+                semaphore.release()
+                raise
+    except BaseException:
+        forget()
+        raise
+
+    released = False
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            CHAT_SEM.release()
+            semaphore.release()
+            forget()
+    return release
+
+# Coalesce small streamed deltas into larger writes so each ASGI send carries more
+# text. The first delta is yielded immediately; after that, buffered text is yielded
+# once it reaches STREAM_FLUSH_CHARS or has waited STREAM_FLUSH_INTERVAL seconds,
+# even if upstream stalls in between.
+async def coalesce_deltas(deltas: AsyncIterator[str]) -> AsyncIterator[str]:
+    # Upstream is drained by its own task into a queue, so waiting for the next
+    # delta can time out without cancelling the upstream read
+    queue: asyncio.Queue = asyncio.Queue()
+    end = object()
+
+    async def pump():
+        try:
+            async for text in deltas:
+                queue.put_nowait(text)
+        except Exception as e:
+            queue.put_nowait(e)
+        queue.put_nowait(end)
+
+    pump_task = asyncio.create_task(pump())
+    buffer = []
+    size = 0
+    deadline = None
+    first = True
+    try:
+        while True:
+            # With text buffered, only wait until its flush window closes
+            timeout = None if not buffer else max(0.0, deadline - time.monotonic())
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                yield "".join(buffer)
+                buffer.clear()
+                size = 0
+                continue
+
+            if item is end:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            if not buffer:
+                # Open a new flush window when the buffer starts filling
+                deadline = time.monotonic() + STREAM_FLUSH_INTERVAL
+            buffer.append(item)
+            size += len(item)
+            if first or size >= STREAM_FLUSH_CHARS or time.monotonic() >= deadline:
+                first = False
+                yield "".join(buffer)
+                buffer.clear()
+                size = 0
+
+        # Flush whatever is left once the stream ends
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        # Stop reading upstream if the client went away mid-stream
+        pump_task.cancel()
+
+# Manage application startup/shutdown; cached clients are closed on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    while _clients:
+        _, client = _clients.popitem()
+        await client.close()
 
 # Initialize FastAPI application with a title
-app = FastAPI(title="OpenAI Chat API")
+# JSON responses are serialized with orjson instead of the stdlib json encoder
+app = FastAPI(title="OpenAI Chat API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Configure CORS (Cross-Origin Resource Sharing) middleware
 # This allows the API to be accessed from different domains/origins
@@ -25,42 +198,63 @@ app.add_middleware(
 # Define the data model for chat requests using Pydantic
 # This ensures incoming request data is properly validated
 class ChatRequest(BaseModel):
+    # Requests are read-only once validated, and unknown fields are rejected
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     system_message: str  # Message from the developer/system
     user_message: str      # Message from the user
-    model: Optional[str] = "gpt-4.1-mini"  # Optional model selection with default
+    model: str = "gpt-4.1-mini"  # Model selection, defaults to gpt-4.1-mini when omitted
     api_key: str          # OpenAI API key for authentication
-    temperature: Optional[float] = 0.7  # Temperature for controlling creativity (0-2)
+    temperature: float = 0.7  # Temperature for controlling creativity (0-2)
 
 # Define the main chat endpoint that handles POST requests
 @app.post("/api/chat")
 async def chat(request: ChatRequest):
     try:
-        # Initialize OpenAI client with the provided API key
-        client = OpenAI(api_key=request.api_key)
-        
+        # Get the (cached) OpenAI client for the provided API key
+        client = get_client(request.api_key)
+
+        # Wait (bounded) for a free slot before the response starts, so a busy key
+        # or a saturated server gets a 429 rather than a stalled stream. The slot is
+        # released from the generator when the stream finishes or fails, or from
+        # the response's background task if the generator never ran.
+        try:
+            release = await acquire_chat_slot(request.api_key, CHAT_QUEUE_TIMEOUT)
+        except TimeoutError:
+            raise HTTPException(status_code=429, detail="Too many concurrent chat requests, please retry shortly")
+
         # Create an async generator function for streaming responses
         async def generate():
-            # Create a streaming chat completion request
-            stream = client.chat.completions.create(
-                model=request.model,
-                messages=[
-                    {"role": "system", "content": request.system_message},
-                    {"role": "system", "content": "Do not produce answers greater than 500 words"},
-                    {"role": "system", "content": "Use $...$ for inline math and $$...$$ for block math. Do not use square brackets [ ... ] for mathematical expressions. Remove any spaces between the closing $ and the content of the expression."},
-                    {"role": "user", "content": request.user_message}
-                ],
-                stream=True,  # Enable streaming response
-                temperature=request.temperature
-            )
-
-            # Yield each chunk of the response as it becomes available
-            for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
-                    yield chunk.choices[0].delta.content
+            try:
+                # Create a streaming chat completion request
+                stream = await client.chat.completions.create(
+                    model=request.model,
+                    messages=[
+                        {"role": "system", "content": request.system_message + "\n\n" + STATIC_SYSTEM_PROMPT},
+                        {"role": "user", "content": request.user_message}
+                    ],
+                    stream=True,  # Enable streaming response
+                    temperature=request.temperature
+                )
+
+                # Pull the text out of each chunk, then coalesce it into larger writes
+                async def deltas():
+                    async for chunk in stream:
+                        content = chunk.choices[0].delta.content
+                        if content:
+                            yield content
+
+                async for text in coalesce_deltas(deltas()):
+                    yield text
+            finally:
+                release()
 
         # Return a streaming response to the client
-        return StreamingResponse(generate(), media_type="text/plain")
-    
+        return StreamingResponse(generate(), media_type="text/plain", background=BackgroundTask(release))
+
+    except HTTPException:
+        # Let deliberate HTTP errors (e.g. the 429 above) through unchanged
+        raise
     except Exception as e:
         # Handle any errors that occur during processing
         raise HTTPException(status_code=500, detail=str(e))
@@ -68,7 +262,8 @@ async def chat(request: ChatRequest):
 # Define a health check endpoint to verify API status
 @app.get("/api/health")
 async def health_check():
-    return {"status": "ok"}
+    # Return the response directly to skip FastAPI's jsonable_encoder pass
+    return ORJSONResponse({"status": "ok"})
 
 # Entry point for running the application directly
 if __name__ == "__main__":
@@ -0,0 +1,81 @@
+# Tests for the streaming helpers in app.py (run from the api directory: python -m pytest)
+import asyncio
+import time
+
+import pytest
+
+import app
+from app import MAX_CACHED_CLIENTS, MAX_CHAT_CONCURRENCY, STREAM_FLUSH_INTERVAL, acquire_chat_slot, coalesce_deltas, get_client
+
+
+# Fake upstream that yields each (delay, text) pair after sleeping for the delay
+async def fake_upstream(events):
+    for delay, text in events:
+        await asyncio.sleep(delay)
+        yield text
+
+
+# Collect (elapsed seconds, text) for every write coalesce_deltas produces
+async def collect(deltas):
+    start = time.monotonic()
+    return [(time.monotonic() - start, text) async for text in coalesce_deltas(deltas)]
+
+
+def test_stalled_upstream_flushes_buffer_within_interval():
+    # "Hello" at 10 ms, " world." at 15 ms, then upstream stalls for 0.5 s
+    writes = asyncio.run(collect(fake_upstream([(0.01, "Hello"), (0.005, " world."), (0.5, " Next")])))
+
+    assert [text for _, text in writes] == ["Hello", " world.", " Next"]
+    # The buffered " world." must go out within the flush window, not after the stall
+    assert writes[1][0] < 0.015 + STREAM_FLUSH_INTERVAL + 0.05
+
+
+def test_burst_is_coalesced_without_losing_text():
+    deltas = [(0.0, "tok ") for _ in range(200)]
+    writes = asyncio.run(collect(fake_upstream(deltas)))
+
+    # The first delta goes out on its own, the rest of the burst is merged
+    assert writes[0][1] == "tok "
+    assert len(writes) < len(deltas)
+    assert "".join(text for _, text in writes) == "tok " * 200
+
+
+def test_upstream_error_is_raised():
+    async def failing():
+        yield "partial"
+        raise RuntimeError("upstream failed")
+
+    with pytest.raises(RuntimeError, match="upstream failed"):
+        asyncio.run(collect(failing()))
+
+
+def test_key_limit_survives_client_eviction():
+    async def scenario():
+        releases = [await acquire_chat_slot("key-a", 1) for _ in range(MAX_CHAT_CONCURRENCY)]
+        # Push key-a's client out of the LRU while its streams are still running
+        for i in range(MAX_CACHED_CLIENTS + 1):
+            get_client(f"other-{i}")
+        with pytest.raises(TimeoutError):
+            await acquire_chat_slot("key-a", 0.05)
+        for release in releases:
+            release()
+        # Once key-a has no streams its limit is dropped
+        assert app._key_limits == {}
+
+    asyncio.run(scenario())
+
+
+def test_release_is_idempotent_and_frees_global_slot(monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(app, "CHAT_SEM", asyncio.Semaphore(1))
+        release = await acquire_chat_slot("key-a", 1)
+        # Another key is still blocked by the process-wide cap
+        with pytest.raises(TimeoutError):
+            await acquire_chat_slot("key-b", 0.05)
+        release()
+        release()
+        assert app.CHAT_SEM._value == 1
+        (await acquire_chat_slot("key-b", 0.05))()
+        assert app._key_limits == {}
+
+    asyncio.run(scenario())